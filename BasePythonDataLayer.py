@@ -11,10 +11,17 @@ from caffe.io import caffe_pb2
 import numpy as np
 import yaml
 import random
+import os
+import sys
+import cPickle
+import hashlib
 from utils.DataManager import (BCFDataManager,
                                CSVDataManager,
                                LMDBDataManager)
-from utils.SampleIO import extract_sample
+from utils.SampleIO import (decode_sample, substract_mean, BatchDecoder)
+from utils.Augmentation import BatchAugmenter
+from utils.util import build_index
+import utils.DataRegistry as DataRegistry
 
 __authors__ = ['Xianming Liu (liuxianming@gmail.com)']
 
@@ -45,6 +52,17 @@ class BasePythonDataLayer(caffe.Layer):
     self._source_type: type of DataManager used for loading data,
           Including: CSV, BCF, LMDB
           plain text files could be parsed by CSVDataManager
+
+    Pipeline state (cursor, shuffle order, sampler iterations and random
+    states) is given by get_state() and restored by set_state(),
+    subclasses extend both. It is saved to
+    state_prefix_iter_N.datastate every state_interval forward passes,
+    and restored at setup from param_str['state_resume'].
+
+    With share_data (default True), layers of the process reading the
+    same source share one copy of data, labels, decompressed data and
+    sampler index (see utils/DataRegistry.py); shared data are never
+    modified in place, each layer keeps its own order and cursor.
     """
 
     def setup(self, bottom, top):
@@ -56,25 +74,61 @@ class BasePythonDataLayer(caffe.Layer):
         self._mean_file = layer_params.get('mean_file', None)
         self._source_type = layer_params.get('source_type', 'CSV')
         self._shuffle = layer_params.get('shuffle', False)
+        self._state_prefix = layer_params.get('state_prefix', None)
+        self._state_interval = int(layer_params.get('state_interval', 0))
+        self._share_data = layer_params.get('share_data', True)
+        self._dataset = None
+        self._forward_count = 0
+        # batch fetched by reshape, consumed by the following forward
+        self._next_batch = None
+        # ids of samples that can not be decoded, never used again
+        self._quarantine = set()
+        self._resume_state = None
+        if layer_params.get('state_resume', None):
+            self._resume_state = self.read_state(
+                layer_params['state_resume'])
         # read image_mean from file and preload all data into memory
         # will read either file or array into self._mean
         self.set_mean()
-        self.preload_db()
         self._compressed = self._layer_params.get('compressed', True)
-        if not self._compressed:
-            self.decompress_data()
+        # dtype of batches from decoding / prefetching to forward:
+        # float32, float16, or uint8 (mean substracted in forward)
+        self._transport = layer_params.get('transport', 'float32')
+        self.preload_db()
+        # decode batches with a thread pool, 0: decode in the solver thread
+        self._decode_threads = int(layer_params.get('decode_threads', 0))
+        self._augmenter = None
+        if any(key in layer_params for key in
+               ['crop_size', 'mirror', 'scale_jitter', 'aspect_jitter']):
+            self._augmenter = BatchAugmenter(layer_params)
+        self._decoder = BatchDecoder(
+            self._decode_threads, self._mean, self._resize,
+            self._augmenter, self._compressed, self._transport)
 
     def decompress_data(self):
+        """Give decompressed copy of self._data,
+        and ids of samples that can not be decoded (None in the copy)
+        """
         print("Decompressing all data...")
-        for i in range(self._sample_count):
-            self._data[i] = extract_sample(
-                self._data[i], self._mean, self._resize)
-
-    def preload_db(self):
-        """Read all images in and all labels
+        data = []
+        for datum in self._data:
+            try:
+                img = decode_sample(datum, self._resize)
+            except:
+                print("{} {}".format(sys.exc_info()[0], sys.exc_info()[1]))
+                data.append(None)
+                continue
+            # uint8: keep pixels, mean is substracted in forward
+            if self._transport != 'uint8':
+                img = img.astype(np.float32)
+                if self._mean is not None:
+                    img = substract_mean(img, self._mean)
+            data.append(img)
+        failed = [i for i in range(len(data)) if data[i] is None]
+        return tuple(data), failed
 
-        Implemenation relies on DataManager Classes
-        """
+    def load_db(self):
+        """Read all data and labels with the DataManager of source_type"""
         print("Preloading Data...")
         if self._source_type == 'BCF':
             self._data_manager = BCFDataManager(self._layer_params)
@@ -82,11 +136,67 @@ class BasePythonDataLayer(caffe.Layer):
             self._data_manager = CSVDataManager(self._layer_params)
         elif self._source_type == 'LMDB':
             self._data_manager = LMDBDataManager(self._layer_params)
-        # read all data
-        self._data, self._label = self._data_manager.load_all()
+        return self._data_manager.load_all()
+
+    def preload_db(self):
+        """Read all images in and all labels
+
+        Implemenation relies on DataManager Classes,
+        data are taken from DataRegistry if another layer loaded them
+        """
+        if self._share_data:
+            key = DataRegistry.dataset_key(
+                self._source_type, self._layer_params)
+            self._dataset = DataRegistry.acquire(key, self.load_db)
+            self._data = self._dataset.data
+            self._label = self._dataset.labels
+        else:
+            self._data, self._label = self.load_db()
+        failed = []
+        if not self._compressed:
+            if self._dataset is not None:
+                self._data, failed = self._dataset.product(
+                    ('decompressed', repr(self._resize), self._transport,
+                     self.mean_digest()), self.decompress_data)
+            else:
+                self._data, failed = self.decompress_data()
         self._sample_count = len(self._data)
         if self._shuffle:
-            self.shuffle()
+            order = None
+            if self._resume_state is not None:
+                order = self._resume_state['order']
+            self.shuffle(order)
+            failed = set(failed)
+            failed = [i for i in range(self._sample_count)
+                      if self._order[i] in failed]
+        if failed:
+            # samplers are created later, and take self._quarantine
+            self._quarantine.update(failed)
+            print("Quarantined {} samples that can not be decoded".format(
+                len(failed)))
+
+    def release(self):
+        """Release shared data, they are freed with the last layer"""
+        if getattr(self, '_dataset', None) is not None:
+            DataRegistry.release(self._dataset.key)
+            self._dataset = None
+
+    def __del__(self):
+        self.release()
+
+    def mean_digest(self):
+        if self._mean is None:
+            return None
+        return hashlib.sha1(np.ascontiguousarray(self._mean)).hexdigest()
+
+    def sampler_index(self):
+        """Shared index of labels for samplers,
+        None if samples are not in the shared order
+        """
+        if self._dataset is None or self._shuffle:
+            return None
+        return self._dataset.product(
+            'index', lambda: build_index(self._dataset.labels))
 
     def data(self):
         return self._data
@@ -115,13 +225,62 @@ class BasePythonDataLayer(caffe.Layer):
     def type(self):
         return "BasePythonDataLayer"
 
-    def shuffle(self):
-        """Shuffle all samples and their labels"""
-        shuffled_data_ = list(zip(self._data, self._label))
-        random.shuffle(shuffled_data_)
-        self._data, self._label = zip(*shuffled_data_)
-        self._data = list(self._data)
-        self._label = list(self._label)
+    def shuffle(self, order=None):
+        """Shuffle all samples and their labels
+
+        The permutation is kept in self._order,
+        give order to apply a saved permutation instead of a random one
+        """
+        if order is None:
+            order = range(len(self._data))
+            random.shuffle(order)
+        self._order = list(order)
+        self._data = [self._data[i] for i in self._order]
+        self._label = [self._label[i] for i in self._order]
+
+    def get_state(self):
+        """State of the data pipeline, as a dict"""
+        return {
+            'order': getattr(self, '_order', None),
+            'forward_count': self._forward_count,
+            'random_state': np.random.get_state(),
+            'py_random_state': random.getstate(),
+            'quarantine': sorted(self._quarantine)
+        }
+
+    def set_state(self, state):
+        self._forward_count = state['forward_count']
+        self.quarantine(state.get('quarantine', []))
+        np.random.set_state(state['random_state'])
+        random.setstate(state['py_random_state'])
+
+    def read_state(self, filename):
+        print("Resuming data layer state from {}".format(filename))
+        with open(filename, 'rb') as fp:
+            return cPickle.load(fp)
+
+    def save_state(self, filename):
+        # write then rename, never leave a partial state file
+        with open(filename + '.tmp', 'wb') as fp:
+            cPickle.dump(self.get_state(), fp, cPickle.HIGHEST_PROTOCOL)
+        os.rename(filename + '.tmp', filename)
+
+    def quarantine(self, ids):
+        """Quarantine ids of samples that can not be decoded
+
+        Give the ids not quarantined before
+        """
+        new_ids = set(ids) - self._quarantine
+        if new_ids:
+            self._quarantine.update(new_ids)
+            print("Quarantined samples {}, {} samples in quarantine".format(
+                sorted(new_ids), len(self._quarantine)))
+        return new_ids
+
+    def decode_batch(self, samples):
+        """Decode (and augment) a list of samples
+        into a numpy array of the batch"""
+        return self._decoder.decode(samples)
 
     def get_next_minibatch(self):
         """Generate next mini-batch
@@ -134,15 +293,30 @@ class BasePythonDataLayer(caffe.Layer):
         pass
 
     def forward(self, bottom, top):
-        blob = self.get_next_minibatch()
+        blob = self._next_batch
+        self._next_batch = None
+        if blob is None:
+            blob = self.get_next_minibatch()
         for i in range(len(blob)):
             top[i].reshape(*(blob[i].shape))
-            top[i].data[...] = blob[i].astype(np.float32, copy=False)
+            # converted to float32 while writing into the blob
+            top[i].data[...] = blob[i]
+            if blob[i].dtype == np.uint8:
+                # uint8 transport: images still need mean substraction
+                self._decoder.substract_mean(top[i].data)
+        self._forward_count += 1
+        if self._state_prefix and self._state_interval and \
+           self._forward_count % self._state_interval == 0:
+            self.save_state('{}_iter_{}.datastate'.format(
+                self._state_prefix, self._forward_count))
 
     def backward(self, top, propagate_down, bottom):
         pass
 
     def reshape(self, bottom, top):
-        blob = self.get_next_minibatch()
+        # keep the batch for forward, one batch per iteration
+        if self._next_batch is None:
+            self._next_batch = self.get_next_minibatch()
+        blob = self._next_batch
         for i in range(len(blob)):
             top[i].reshape(*(blob[i].shape))
@@ -4,18 +4,26 @@ Base Sampler class definintion
 Implement __init__, build_index, sample() functions
 """
 
-from utils.util import parse_label
+import numpy as np
+from utils.util import (build_index, parse_label)
 
 __author__ = ['Xianming Liu(liuxianming@gmail.com)']
 
 
 class BaseSampler(object):
-    def __init__(self, labels):
+    def __init__(self, labels, index=None):
         """self._funcdict is preserved to customrized sampling functions
+
+        index: prebuilt index of labels (e.g. shared by several layers),
+               it is never modified
         """
         self._labels = labels
         self._funcdict = dict()
-        self._build_index()
+        if index is None:
+            self._build_index()
+        else:
+            self._sample_count = len(self._labels)
+            self._index = index
 
     def _build_index(self):
         """Build Index to randomly fetch samples from data
@@ -24,15 +32,7 @@ class BaseSampler(object):
         {label: [list of sample id]}
         """
         self._sample_count = len(self._labels)
-        self._index = dict()
-        for id in range(self._sample_count):
-            # parse label and insert into self._index
-            labels_ = parse_label(self._labels[id])
-            for label_ in labels_:
-                if label_ in self._index.keys():
-                    self._index[label_].append(id)
-                else:
-                    self._index[label_] = [id]
+        self._index = build_index(self._labels)
 
     def sample(self):
         """Function to run sampling
@@ -44,3 +44,37 @@ class BaseSampler(object):
         """
         self._iteration += 1
         return self._funcdict[self._sampling_type]()
+
+    def get_state(self):
+        """Iteration counter and random state, to resume sampling"""
+        return {
+            'iteration': getattr(self, '_iteration', 0),
+            'random_state': np.random.get_state()
+        }
+
+    def set_state(self, state):
+        self._iteration = state['iteration']
+        if state['random_state'] is not None:
+            np.random.set_state(state['random_state'])
+
+    def quarantine(self, ids):
+        """Remove sample ids from the index, they are never sampled again
+
+        Labels left without samples are removed as well
+        """
+        ids = set(ids)
+        if not ids:
+            return
+        affected = set()
+        for id in ids:
+            affected.update(parse_label(self._labels[id]))
+        # the index may be shared: copy the dict,
+        # and rebuild only the lists of affected labels
+        self._index = dict(self._index)
+        for label_ in affected:
+            if label_ not in self._index:
+                continue
+            self._index[label_] = [
+                id for id in self._index[label_] if id not in ids]
+            if not self._index[label_]:
+                del self._index[label_]
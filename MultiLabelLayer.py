@@ -7,7 +7,6 @@ For the labels, the output will be a probabilistic array or binary array
 
 import numpy as np
 from BasePythonDataLayer import BasePythonDataLayer
-from utils.SampleIO import extract_sample
 from utils.util import parse_label
 
 __author__ = ['Xianming Liu(liuxianming@gmail.com)']
@@ -28,6 +27,8 @@ class MultiLabelLayer(BasePythonDataLayer):
                 # try to estimate the dimension of labels
                 self.calculate_label_dim()
         self._cur = 0
+        if self._resume_state is not None:
+            self.set_state(self._resume_state)
 
     def calculate_label_dim(self):
         """Calculate the dimension of labels
@@ -40,32 +41,46 @@ class MultiLabelLayer(BasePythonDataLayer):
         all_labels = set(all_labels)
         self._label_dim = len(all_labels)
 
-    def get_a_datum(self):
-        if self._compressed:
-            datum = extract_sample(
-                self._data[self._cur], self._mean, self._resize)
-        else:
-            datum = self._data[self._cur]
-        # start parsing labels
-        label_elems = parse_label(self._label[self._cur])
+    def get_state(self):
+        state = super(MultiLabelLayer, self).get_state()
+        state['cur'] = self._cur
+        return state
+
+    def set_state(self, state):
+        super(MultiLabelLayer, self).set_state(state)
+        self._cur = state['cur']
+
+    def get_label(self, idx):
+        label_elems = parse_label(self._label[idx])
         label = np.zeros(self._label_dim)
         if not self._multilabel:
             label[0] = label_elems[0]
         else:
             for i in label_elems:
                 label[i] = 1
-        self._cur = (self._cur + 1) % self._sample_count
-        return datum, label
+        return label
+
+    def next_ids(self):
+        """Ids of the next batch, skipping quarantined samples"""
+        if len(self._quarantine) >= self._sample_count:
+            raise Exception("All samples are in quarantine")
+        ids = []
+        while len(ids) < self._batch_size:
+            if self._cur not in self._quarantine:
+                ids.append(self._cur)
+            self._cur = (self._cur + 1) % self._sample_count
+        return ids
 
     def get_next_minibatch(self):
-        data = []
-        labels = []
-        for i in range(self._batch_size):
-            datum, label = self.get_a_datum()
-            data.append(datum)
-            labels.append(label)
+        while True:
+            ids = self.next_ids()
+            data = self.decode_batch([self._data[i] for i in ids])
+            # samples failed to decode: quarantine them and start over
+            if not self.quarantine([ids[i] for i in self._decoder.failed]):
+                break
+        labels = [self.get_label(i) for i in ids]
         batch = [
-            np.array(data),
+            data,
             np.array(labels).reshape(self._batch_size, self._label_dim, 1, 1)
         ]
         return batch
@@ -0,0 +1,119 @@
+"""Copyright @ Xianming Liu, University of Illinois at Urbana-Champaign
+
+Offline re-encoding of a dataset at training resolution
+
+Read any source supported by DataManager (CSV, LMDB, BCF), resize every
+image to the target size and re-encode it as JPEG of given quality
+(or store raw uint8 pixels), in parallel,
+then write a BCF file and a label file readable by BCFDataManager.
+
+Example:
+python ReencodeDataset.py --source_type CSV --source train.csv \\
+    --root images/ --resize 256 256 --quality 90 \\
+    --output train.bcf --output_labels train_labels.txt
+"""
+
+import argparse
+import sys
+import time
+import numpy as np
+from multiprocessing import (Pool, cpu_count)
+from utils.DataManager import (BCFDataManager,
+                               CSVDataManager,
+                               LMDBDataManager)
+from utils.SampleIO import (decode_imgstr, encode_img)
+from utils.bcfstore import bcf_writer
+import scipy.misc
+
+__authors__ = ['Xianming Liu (liuxianming@gmail.com)']
+
+
+def reencode(args):
+    """Decode, resize and encode one sample, None if it fails"""
+    datum, resize, quality, raw = args
+    try:
+        img_data = decode_imgstr(datum)
+        if resize is not None:
+            img_data = scipy.misc.imresize(img_data, tuple(resize))
+        return encode_img(img_data, quality, raw)
+    except:
+        print sys.exc_info()[0], sys.exc_info()[1]
+        return
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Re-encode a dataset at training resolution into BCF")
+    parser.add_argument('--source_type', default='CSV',
+                        choices=['CSV', 'LMDB', 'BCF'])
+    parser.add_argument('--source', required=True)
+    parser.add_argument('--labels', default=None,
+                        help="label file (BCF) or label LMDB")
+    parser.add_argument('--root', default=None,
+                        help="root dir of images in CSV")
+    parser.add_argument('--resize', type=int, nargs='+', default=None,
+                        help="target size, HEIGHT [WIDTH]")
+    parser.add_argument('--quality', type=int, default=95,
+                        help="JPEG quality")
+    parser.add_argument('--raw', action='store_true',
+                        help="store raw uint8 pixels instead of JPEG")
+    parser.add_argument('--processes', type=int, default=cpu_count())
+    parser.add_argument('--output', required=True, help="output BCF file")
+    parser.add_argument('--output_labels', required=True,
+                        help="output label file")
+    args = parser.parse_args()
+    if args.source_type == 'BCF' and not args.labels:
+        parser.error("--labels is required with --source_type BCF")
+    return args
+
+
+def main():
+    args = parse_args()
+    resize = args.resize
+    if resize is not None and len(resize) == 1:
+        resize = resize * 2
+    param = {'source': args.source, 'root': args.root}
+    if args.labels:
+        param['labels'] = args.labels
+    if args.source_type == 'BCF':
+        data_manager = BCFDataManager(param)
+    elif args.source_type == 'CSV':
+        data_manager = CSVDataManager(param)
+    elif args.source_type == 'LMDB':
+        data_manager = LMDBDataManager(param)
+    data, labels = data_manager.load_all()
+    for label in labels:
+        if ':' in str(label):
+            raise Exception("BCF label file supports a single label "
+                            "for each sample, got {}".format(label))
+
+    start = time.time()
+    print("Re-encoding {} samples with {} processes...".format(
+        len(data), args.processes))
+    pool = Pool(args.processes)
+    encoded = pool.imap(
+        reencode, ((datum, resize, args.quality, args.raw) for datum in data),
+        chunksize=64)
+    samples = []
+    kept_labels = []
+    for idx, datum in enumerate(encoded):
+        if datum is None:
+            print("Sample {} can not be decoded, skip".format(idx))
+            continue
+        samples.append(datum)
+        kept_labels.append(labels[idx])
+    pool.close()
+    pool.join()
+
+    writer = bcf_writer(args.output, len(samples))
+    for datum in samples:
+        writer.write(datum)
+    writer.close()
+    np.savetxt(args.output_labels,
+               np.array(kept_labels).astype(float).astype(int), fmt='%d')
+    print("Writing {} samples Done: Time cost {} seconds".format(
+        len(samples), time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,19 @@ Implementation of Triplet Data Layer
 
 """
 import atexit
+import os
+import signal
+import time
+import traceback
 import numpy as np
 from BasePythonDataLayer import BasePythonDataLayer
-from multiprocessing import (Process, Pipe)
-from utils.SampleIO import extract_sample
+from multiprocessing import (Process, Queue, Semaphore, Event, Value,
+                             cpu_count)
+from Queue import Empty
+from utils.SampleIO import BatchDecoder
+from utils.PrefetchTuner import PrefetchTuner
+from utils.affinity import (plan_worker_cpus, pin_main_process,
+                            set_affinity, limit_threads)
 from TripletSampler import TripletSampler
 
 __authors__ = ['Xianming Liu(liuxianming@gmail.com)']
@@ -22,6 +31,12 @@ class TripletDataLayer(BasePythonDataLayer):
           anchor image, positive and negative ones
     Label: Relative Similarity (Optional)
 
+    With sampling type PK, outputs are
+    Data: (p * k or less) * channels * width * height, distinct images
+    Anchors, Positives, Negatives: n_triplets * 1 * 1 * 1,
+          position of images of each triplet mined in the batch
+    Margins: n_triplets * 1 * 1 * 1
+
     Implemenation is based on BasePythonDataLayer,
     need to implement:
     1. get_next_minibatch(self) function
@@ -33,81 +48,364 @@ class TripletDataLayer(BasePythonDataLayer):
         super(TripletDataLayer, self).setup(bottom, top)
         print("Using Triplet Python Data Layer")
         # prefetch or not: default = False
-        self._sampling_type = self._layer_params.get('type', 'RANDOM')
+        self._sampling_type = self._layer_params.get('type', 'RANDOM').upper()
         self._prefetch = self._layer_params.get('prefetch', False)
         """Construct kwargs:
         possible fields:
         k - number of candidates when hard negative sampling
         m - similarity graph filename for hard negative sampling
         n - number of iterations before hard negative sampling
+        p - number of classes in a batch for PK sampling
+        mining - ALL or BATCH_HARD, for PK sampling
         """
         kwargs = {}
         for key, value in self._layer_params.iteritems():
-            if key.lower() in ['k', 'm', 'n']:
+            if key.lower() in ['k', 'm', 'n', 'p', 'mining']:
                 kwargs[key.lower()] = value
+        if self._sampling_type == 'PK':
+            # k images per class, and batch_size / k classes by default
+            kwargs['k'] = int(kwargs.get('k', 4))
+            if kwargs['k'] < 2:
+                raise Exception("PK sampling needs k >= 2")
+            kwargs['p'] = int(kwargs.get(
+                'p', max(self._batch_size // kwargs['k'], 2)))
+        self._kwargs = kwargs
+        self._sampler = None
+        self._prefetch_workers = []
+        if self._resume_state is not None:
+            self.set_state(self._resume_state)
         if self._prefetch:
-            # using prefetch to generate mini-batches
-            self._conn, conn = Pipe()
-            self._prefetch_process = TripletPrefetcher(
-                conn,
-                self._label, self._data,
-                self._mean, self._resize, self._batch_size,
-                self._sampling_type, **kwargs
-            )
-            print("Start Prefetching Process...")
-            self._prefetch_process.start()
-
-            def cleanup():
-                print("Terminating Prefetching Processs...")
-                self._prefetch_process.terminate()
-                self._prefetch_process.join()
-                self._conn.close()
-            atexit.register(cleanup)
+            self.setup_prefetch()
         else:
             self._sampler = TripletSampler(
-                self._sampling_type, self._label, **kwargs)
+                self._sampling_type, self._label,
+                index=self.sampler_index(), **kwargs)
+            self._sampler.quarantine(self._quarantine)
+            if self._resume_state is not None and \
+               'sampler' in self._resume_state:
+                self._sampler.set_state(self._resume_state['sampler'])
         self.reshape(bottom, top)
 
-    def get_a_datum(self):
-        """Get a datum:
+    def setup_prefetch(self):
+        """Start prefetching processes
+
+        Each worker puts finished batches into its own queue, and batches
+        are consumed from workers in turn (round robin).
+        A worker produces a batch only after taking one of its tokens,
+        the layer counts tokens given to each worker (self._credits)
+        and gives one back when it consumes a batch of the worker,
+        so there are at most workers + depth batches in flight.
+        A worker that dies or is killed only loses its own queue,
+        its missing batches are given as tokens to its replacement.
+
+        possible fields:
+        prefetch_workers - number of prefetching processes, default 1
+        prefetch_depth - number of batches waiting in queue, default 1
+        prefetch_adaptive - tune workers and depth on the fly, default False
+        prefetch_max_workers - default #cpu - 1
+        prefetch_max_depth - default 8
+        prefetch_max_memory - MB of batches in flight, default 2048
+        prefetch_tune_interval - batches between decisions, default 20
+
+        CPU placement:
+        prefetch_affinity - pin each worker to its own cores, NUMA aware,
+                            default False
+        prefetch_cores_per_worker - default 1
+        prefetch_cpus - cores usable by workers, default all
+        reserved_cores - cores kept for the solver process, list of cores
+                         or number of cores of the first NUMA node,
+                         default 1
+        pin_solver - also pin the solver process to reserved_cores,
+                     only with prefetch_affinity, default False
+        prefetch_lib_threads - cap of numpy / BLAS / OpenMP / OpenCV
+                               threads in each worker, default None
+
+        Health:
+        prefetch_timeout - seconds without sign of life before a worker
+                           is respawned, default 60
+        prefetch_max_respawns - respawns of a worker without any batch
+                                from it before giving up, default 5
+        Exceptions raised in a worker are raised again by the layer
+        """
+        params = self._layer_params
+        workers = int(params.get('prefetch_workers', 1))
+        depth = int(params.get('prefetch_depth', 1))
+        self._depth = depth
+        # tokens given to each worker and not consumed yet
+        self._credits = dict()
+        # position of the worker giving the next batch
+        self._turn = 0
+        # tokens to hold back when the pipeline shrinks
+        self._token_debt = 0
+        self._retired_workers = []
+        self._prefetch_timeout = float(params.get('prefetch_timeout', 60))
+        self._respawn_count = 0
+        self._max_respawns = int(params.get('prefetch_max_respawns', 5))
+        # respawns of each worker since its last batch
+        self._failures = dict()
+        # sampler state of the last consumed batch of each worker
+        self._worker_states = dict()
+        if self._resume_state is not None:
+            self._worker_states = self._resume_state.get('workers', dict())
+            self._turn = self._resume_state.get('prefetch_turn', 0) % workers
+        self._next_worker_id = 0
+        self._worker_cpus = None
+        if params.get('prefetch_affinity', False):
+            # enough core sets for workers added by tuning
+            self._worker_cpus = plan_worker_cpus(
+                max(workers, cpu_count()),
+                int(params.get('prefetch_cores_per_worker', 1)),
+                params.get('reserved_cores', 1),
+                params.get('prefetch_cpus', None))
+        self._lib_threads = params.get('prefetch_lib_threads', None)
+        self._tuner = None
+        if params.get('prefetch_adaptive', False):
+            self._tuner = PrefetchTuner(
+                workers, depth,
+                max_workers=int(params.get('prefetch_max_workers', 0)),
+                max_depth=int(params.get('prefetch_max_depth', 8)),
+                max_memory=int(
+                    params.get('prefetch_max_memory', 2048)) * 1024 ** 2,
+                interval=int(params.get('prefetch_tune_interval', 20)))
+        print("Start Prefetching Process...")
+        for i in range(workers):
+            self.add_prefetch_worker()
+        self.give_tokens(depth)
+        if params.get('pin_solver', False):
+            if self._worker_cpus is None:
+                # workers would inherit the reserved cores
+                print("pin_solver needs prefetch_affinity, ignored")
+            else:
+                cpus = pin_main_process(params.get('reserved_cores', 1))
+                if cpus:
+                    print("Solver process pinned to cores {}".format(cpus))
+
+        def cleanup():
+            print("Terminating Prefetching Processs...")
+            for worker in self._prefetch_workers + self._retired_workers:
+                worker.terminate()
+                worker.join()
+        atexit.register(cleanup)
+
+    def add_prefetch_worker(self, worker_id=None, state=None, tokens=1,
+                            position=None):
+        """Start a worker with tokens to produce batches,
+        at the end of the round robin, or in place of the worker at
+        position
+        """
+        if worker_id is None:
+            worker_id = self._next_worker_id
+            self._next_worker_id += 1
+            state = self._worker_states.get(worker_id, None)
+        worker = TripletPrefetcher(
+            worker_id, state, tokens,
+            self._label, self._data,
+            self._mean, self._resize, self._batch_size,
+            self._decode_threads, self._augmenter, self._transport,
+            self._sampling_type, index=self.sampler_index(),
+            **self._kwargs
+        )
+        cpus = None
+        if self._worker_cpus:
+            cpus = self._worker_cpus[worker_id % len(self._worker_cpus)]
+        worker.set_placement(cpus, self._lib_threads)
+        worker.send_quarantine(self._quarantine)
+        worker.daemon = True
+        worker.start()
+        self._credits[worker_id] = tokens
+        if position is None:
+            self._prefetch_workers.append(worker)
+        else:
+            self._prefetch_workers[position] = worker
+
+    def remove_prefetch_worker(self):
+        """Stop the last worker, its batches not consumed yet are dropped
+        and its tokens go to the other workers
+        """
+        worker = self._prefetch_workers.pop()
+        worker.stop()
+        self._retired_workers.append(worker)
+        self._turn %= len(self._prefetch_workers)
+        self.give_tokens(self._credits.pop(worker.worker_id()))
+
+    def check_workers(self):
+        """Respawn workers that died or stopped giving signs of life"""
+        now = time.time()
+        for position, worker in enumerate(list(self._prefetch_workers)):
+            if worker.is_alive():
+                if now - worker.heartbeat() < self._prefetch_timeout:
+                    continue
+                print("Prefetcher {} stalled for {:.0f} seconds".format(
+                    worker.worker_id(), now - worker.heartbeat()))
+                worker.terminate()
+                worker.join(5)
+                if worker.is_alive():
+                    # SIGTERM is not handled by a hung or stopped process
+                    os.kill(worker.pid, signal.SIGKILL)
+            else:
+                print("Prefetcher {} died with exit code {}".format(
+                    worker.worker_id(), worker.exitcode))
+            worker.join()
+            # its queue may be broken, drop it with the batches in it;
+            # the replacement makes all batches not consumed yet
+            tokens = self._credits.pop(worker.worker_id())
+            failures = self._failures.get(worker.worker_id(), 0) + 1
+            if failures > self._max_respawns:
+                raise Exception(
+                    "Prefetcher {} failed {} times without giving a batch, "
+                    "giving up".format(worker.worker_id(), failures))
+            self._failures[worker.worker_id()] = failures
+            # keep counters, but do not replay the batch that failed
+            state = self._worker_states.get(worker.worker_id(), None)
+            if state is not None:
+                state = dict(state, random_state=None)
+            self.add_prefetch_worker(
+                worker.worker_id(), state, tokens, position)
+            self._respawn_count += 1
+            print("Prefetcher {} respawned, {} respawns in total".format(
+                worker.worker_id(), self._respawn_count))
 
-        Sampling -> decode images -> stack numpy array
+    def get_prefetched(self):
+        """Get a batch from the worker in turn,
+        checking worker health meanwhile
         """
-        sample = self._sampler.sample()
-        if self._compressed:
-            datum_ = [
-                extract_sample(self._data[id], self._mean, self._resize) for
-                id in sample[:3]]
+        self.check_workers()
+        start = time.time()
+        while True:
+            worker = self._prefetch_workers[self._turn]
+            try:
+                message = worker.get(timeout=1)
+            except Empty:
+                if time.time() - start > self._prefetch_timeout:
+                    print("No batch from prefetcher {} in {} seconds".format(
+                        worker.worker_id(), self._prefetch_timeout))
+                    start = time.time()
+                self.check_workers()
+                continue
+            except (EOFError, IOError):
+                # the worker exited, maybe in the middle of a batch
+                worker.join(1)
+                self.check_workers()
+                continue
+            if message[0] is None:
+                # exception in the worker, it would repeat after respawn
+                raise Exception("Prefetcher {} failed:\n{}".format(
+                    worker.worker_id(), message[-1]))
+            self._turn = (self._turn + 1) % len(self._prefetch_workers)
+            self._credits[worker.worker_id()] -= 1
+            self._failures[worker.worker_id()] = 0
+            return message
+
+    def quarantine(self, ids):
+        new_ids = super(TripletDataLayer, self).quarantine(ids)
+        if new_ids:
+            if self._sampler is not None:
+                self._sampler.quarantine(new_ids)
+            for worker in self._prefetch_workers:
+                worker.send_quarantine(new_ids)
+        return new_ids
+
+    def give_tokens(self, n, worker_id=None):
+        """Give n tokens to worker_id, or to the workers holding
+        the fewest tokens; negative n takes tokens back
+        """
+        if n < 0:
+            self._token_debt -= n
+            return
+        candidates = [w for w in self._prefetch_workers
+                      if w.worker_id() == worker_id] or self._prefetch_workers
+        for i in range(n):
+            worker = min(candidates,
+                         key=lambda w: self._credits[w.worker_id()])
+            # every worker keeps a token, or its turn never comes
+            if self._token_debt and self._credits[worker.worker_id()]:
+                self._token_debt -= 1
+                continue
+            worker.give_token()
+            self._credits[worker.worker_id()] += 1
+
+    def tune_prefetch(self, wait, cost, batch):
+        decision = self._tuner.update(
+            wait, cost, sum(x.nbytes for x in batch))
+        # retired workers exit after their current batch
+        self._retired_workers = [
+            w for w in self._retired_workers if w.is_alive()]
+        if decision is None:
+            return
+        workers, depth, reason = decision
+        print("Prefetch tuning: {} workers -> {}, depth {} -> {}: {}".format(
+            len(self._prefetch_workers), workers,
+            self._depth, depth, reason))
+        # new workers start with one token, removed workers give theirs
+        # to the others
+        tokens = workers + depth - len(self._prefetch_workers) - self._depth
+        while len(self._prefetch_workers) < workers:
+            self.add_prefetch_worker()
+            tokens -= 1
+        while len(self._prefetch_workers) > workers:
+            self.remove_prefetch_worker()
+        self.give_tokens(tokens)
+        self._depth = depth
+
+    def get_state(self):
+        state = super(TripletDataLayer, self).get_state()
+        if self._prefetch:
+            state['workers'] = dict(self._worker_states)
+            state['prefetch_turn'] = self._turn
         else:
-            datum_ = [self._data[id] for id in sample[:3]]
-        if len(sample) == 4:
-            datum_.append(sample[-1])
-        return datum_
+            state['sampler'] = self._sampler.get_state()
+        return state
+
+    def get_triplet_minibatch(self):
+        """Sample batch_size triplets, then decode all images at once
+
+        If some images can not be decoded, they are quarantined,
+        and the batch is sampled again
+        """
+        while True:
+            samples = [self._sampler.sample()
+                       for i in range(self._batch_size)]
+            ids = [sample[j] for j in range(3) for sample in samples]
+            images = self.decode_batch([self._data[id] for id in ids])
+            if not self.quarantine([ids[i] for i in self._decoder.failed]):
+                break
+        n = self._batch_size
+        batch = [images[:n], images[n:2 * n], images[2 * n:]]
+        if len(samples[0]) == 4:
+            # label / margin
+            label = np.array([sample[-1] for sample in samples])
+            batch.append(label.reshape(self._batch_size, 1, 1, 1))
+        return batch
+
+    def get_pk_minibatch(self):
+        """P x K batch: decode each distinct image once,
+        and give positions of mined triplets
+        """
+        while True:
+            sample = self._sampler.sample()
+            ids = sample[0]
+            images = self.decode_batch([self._data[id] for id in ids])
+            if not self.quarantine([ids[i] for i in self._decoder.failed]):
+                break
+        batch = [images]
+        for x in sample[1:]:
+            batch.append(np.array(x).reshape(len(x), 1, 1, 1))
+        return batch
 
     def get_next_minibatch(self):
         if self._prefetch:
             # get mini-batch from prefetcher
-            batch = self._conn.recv()
+            start = time.time()
+            batch, cost, worker_id, state, bad_ids = self.get_prefetched()
+            self._worker_states[worker_id] = state
+            self.quarantine(bad_ids)
+            self.give_tokens(1, worker_id)
+            if self._tuner is not None:
+                self.tune_prefetch(time.time() - start, cost, batch)
+        elif self._sampling_type == 'PK':
+            batch = self.get_pk_minibatch()
         else:
-            # generate using in-thread functions
-            data = []
-            p_data = []
-            n_data = []
-            label = []
-            for i in range(self._batch_size):
-                datum_ = self.get_a_datum()
-                data.append(datum_[0])
-                p_data.append(datum_[1])
-                n_data.append(datum_[2])
-                if len(datum_) == 4:
-                    # datum and label / margin
-                    label.append(datum_[-1])
-            batch = [np.array(data),
-                     np.array(p_data),
-                     np.array(n_data)]
-            if len(label):
-                label = np.array(label).reshape(self._batch_size, 1, 1, 1)
-                batch.append(label)
+            batch = self.get_triplet_minibatch()
         return batch
 
 
@@ -116,13 +414,33 @@ class TripletPrefetcher(Process):
 
     Use a separate process to sample triplets,
     following the same function implementations as TripletDataLayer
+
+    Batches are put into its own queue, read by get(), together with
+    the time spent on them, the worker id, the sampler state after the
+    batch and the ids of samples quarantined while making it;
+    one token is taken before producing each batch, starting with
+    tokens, more are given by give_token().
+    If state is given, sampling resumes from it
+
+    Ids quarantined by the layer are received through send_quarantine(),
+    the layer watches heartbeat() to detect stalls
     """
-    def __init__(self, conn, labels, data,
+    def __init__(self, worker_id, state, tokens, labels, data,
                  mean, resize, batch_size,
+                 decode_threads, augmenter, transport,
                  # samping related parameters
                  sampling_type, **kwargs):
         super(TripletPrefetcher, self).__init__()
-        self._conn = conn
+        self._worker_id = worker_id
+        self._state = state
+        self._queue = Queue()
+        self._tokens = Semaphore(tokens)
+        self._stop_event = Event()
+        self._control = Queue()
+        self._heartbeat = Value('d', time.time(), lock=False)
+        self._quarantine = set()
+        # quarantined since the last batch, reported with the next one
+        self._new_quarantine = set()
         self._labels = labels
         self._data = data
         if type(self._data[0]) is not str:
@@ -133,6 +451,12 @@ class TripletPrefetcher(Process):
         self._batch_size = batch_size
         self._mean = mean
         self._resize = resize
+        self._decode_threads = decode_threads
+        self._augmenter = augmenter
+        self._transport = transport
+        self._decoder = None
+        self._cpus = None
+        self._lib_threads = None
         self._sampling_type = sampling_type
         # kwargs is a dictionary related with sampling
         self._sampler = TripletSampler(
@@ -141,47 +465,142 @@ class TripletPrefetcher(Process):
     def type(self):
         return "TripletPrefetcher"
 
-    def get_a_datum(self):
-        """Get a datum:
+    def stop(self):
+        """Let the process exit after the batch in progress"""
+        self._stop_event.set()
+
+    def worker_id(self):
+        return self._worker_id
+
+    def heartbeat(self):
+        """Time of the last sign of life"""
+        return self._heartbeat.value
+
+    def start(self):
+        super(TripletPrefetcher, self).start()
+        # only the worker writes to its queue, so that reading gives
+        # EOFError instead of hanging if the worker dies in a batch
+        self._queue._writer.close()
 
-        Sampling -> decode images -> stack numpy array
+    def get(self, timeout=None):
+        """Next batch of the worker, raise Queue.Empty after timeout,
+        EOFError or IOError if the worker is gone
         """
-        sample = self._sampler.sample()
-        if self._compressed:
-            datum_ = [
-                extract_sample(self._data[id], self._mean, self._resize) for
-                id in sample[:3]]
-        else:
-            datum_ = [self._data[id] for id in sample[:3]]
-        if len(sample) == 4:
-            datum_.append(sample[-1])
-        return datum_
+        return self._queue.get(timeout=timeout)
 
-    def get_next_minibatch(self):
-        # generate using in-thread functions
-        data = []
-        p_data = []
-        n_data = []
-        label = []
-        for i in range(self._batch_size):
-            datum_ = self.get_a_datum()
-            # print(len(datum_), ":".join([str(x.shape) for x in datum_]))
-            data.append(datum_[0])
-            p_data.append(datum_[1])
-            n_data.append(datum_[2])
-            if len(datum_) == 4:
-                # datum and label / margin
-                label.append(datum_[-1])
-        batch = [np.array(data),
-                 np.array(p_data),
-                 np.array(n_data)]
-        if len(label):
-            label = np.array(label).reshape(self._batch_size, 1, 1, 1)
-            batch.append(label)
+    def give_token(self):
+        self._tokens.release()
+
+    def send_quarantine(self, ids):
+        if ids:
+            self._control.put(list(ids))
+
+    def receive_quarantine(self):
+        while True:
+            try:
+                ids = self._control.get_nowait()
+            except Empty:
+                return
+            self._quarantine.update(ids)
+            self._sampler.quarantine(ids)
+
+    def quarantine(self, ids):
+        new_ids = set(ids) - self._quarantine
+        if new_ids:
+            self._quarantine.update(new_ids)
+            self._new_quarantine.update(new_ids)
+            self._sampler.quarantine(new_ids)
+        return new_ids
+
+    def set_placement(self, cpus, lib_threads):
+        """Cores to run on and cap of library threads, call before start"""
+        self._cpus = cpus
+        self._lib_threads = lib_threads
+
+    def decode_batch(self, samples):
+        return self._decoder.decode(samples)
+
+    def get_triplet_minibatch(self):
+        """Sample batch_size triplets, then decode all images at once
+
+        If some images can not be decoded, they are quarantined,
+        and the batch is sampled again
+        """
+        while True:
+            samples = [self._sampler.sample()
+                       for i in range(self._batch_size)]
+            ids = [sample[j] for j in range(3) for sample in samples]
+            images = self.decode_batch([self._data[id] for id in ids])
+            if not self.quarantine([ids[i] for i in self._decoder.failed]):
+                break
+        n = self._batch_size
+        batch = [images[:n], images[n:2 * n], images[2 * n:]]
+        if len(samples[0]) == 4:
+            # label / margin
+            label = np.array([sample[-1] for sample in samples])
+            batch.append(label.reshape(self._batch_size, 1, 1, 1))
         return batch
 
+    def get_pk_minibatch(self):
+        """P x K batch: decode each distinct image once,
+        and give positions of mined triplets
+        """
+        while True:
+            sample = self._sampler.sample()
+            ids = sample[0]
+            images = self.decode_batch([self._data[id] for id in ids])
+            if not self.quarantine([ids[i] for i in self._decoder.failed]):
+                break
+        batch = [images]
+        for x in sample[1:]:
+            batch.append(np.array(x).reshape(len(x), 1, 1, 1))
+        return batch
+
+    def get_next_minibatch(self):
+        if self._sampling_type == 'PK':
+            return self.get_pk_minibatch()
+        return self.get_triplet_minibatch()
+
     def run(self):
         print("Prefetcher Started...")
-        while True:
+        if self._cpus:
+            if set_affinity(self._cpus):
+                print("Prefetcher {} pinned to cores {}".format(
+                    self._worker_id, self._cpus))
+        if self._lib_threads:
+            capped = limit_threads(int(self._lib_threads))
+            print("Prefetcher {} threads capped to {} by {}".format(
+                self._worker_id, self._lib_threads,
+                ', '.join(capped) or 'environment only'))
+        try:
+            self.produce()
+        except Exception:
+            # sent to the layer, which raises it; stay alive until then,
+            # or the worker would be respawned and fail again
+            self._queue.put((None, 0, self._worker_id, None,
+                             traceback.format_exc()))
+            while not self._stop_event.is_set():
+                self._heartbeat.value = time.time()
+                time.sleep(1)
+        # stopped: batches left in the queue are dropped on exit
+        self._queue.cancel_join_thread()
+
+    def produce(self):
+        # forked workers share the parent random state, reseed
+        np.random.seed()
+        if self._state is not None:
+            self._sampler.set_state(self._state)
+        self._decoder = BatchDecoder(
+            self._decode_threads, self._mean, self._resize,
+            self._augmenter, self._compressed, self._transport)
+        while not self._stop_event.is_set():
+            self._heartbeat.value = time.time()
+            if not self._tokens.acquire(timeout=1):
+                continue
+            self.receive_quarantine()
+            start = time.time()
             batch = self.get_next_minibatch()
-            self._conn.send(batch)
+            self._queue.put((batch, time.time() - start,
+                             self._worker_id, self._sampler.get_state(),
+                             sorted(self._new_quarantine)))
+            self._new_quarantine = set()
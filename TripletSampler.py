@@ -39,10 +39,14 @@ class TripletSampler(BaseSampler):
                The input will be a adjacent matrix of all nodes, in order to
                load all the graph to memory.
                - HARD
+    5. P x K sampling: pick p classes and k images for each class,
+               every image is used once, and all triplets inside the batch
+               are mined (see pk_sampling)
+               - PK
     -
     """
-    def __init__(self, sampling_type, labels, **kwargs):
-        super(TripletSampler, self).__init__(labels)
+    def __init__(self, sampling_type, labels, index=None, **kwargs):
+        super(TripletSampler, self).__init__(labels, index)
         self._sampling_type = sampling_type.upper()
         """set other attributes
 
@@ -52,10 +56,15 @@ class TripletSampler(BaseSampler):
                 (in the format of dict)
             n - the number of iterations before hard negative sampling.
                 Run n iterations of randomly sampling then do hard sampling
+        for PK sampling:
+            p - number of classes in a batch
+            k - number of images of each class
+            mining - ALL (all valid triplets) or BATCH_HARD
         """
+        self._mining = 'ALL'
         if kwargs:
             for key, value in kwargs.iteritems():
-                if key.lower() in ['k', 'm', 'n']:
+                if key.lower() in ['k', 'm', 'n', 'p', 'mining']:
                     self.__setattr__('_{}'.format(key.lower()), value)
             print("Set attributes done")
         self._iteration = 0  # counter
@@ -64,8 +73,10 @@ class TripletSampler(BaseSampler):
             'RANDOM': self.random_sampling,
             'RANDOM_MULTILABEL': self.random_multilabel,
             'HARD_MULTILABEL': self.hard_negative_multilabel,
-            'HARD': self.hard_negative_graph
+            'HARD': self.hard_negative_graph,
+            'PK': self.pk_sampling
         }
+        self._mining = self._mining.upper()
 
     def random_sampling(self):
         """Random Sampling of Triplets
@@ -139,3 +150,75 @@ class TripletSampler(BaseSampler):
         simiarity graph is given by self._m
         """
         pass
+
+    def pk_sampling(self):
+        """P x K sampling with in-batch triplet mining
+
+        Pick self._p classes and self._k images of each class,
+        every distinct image shows up once in the batch.
+        A sample is a positive of an anchor if it carries the class
+        the anchor was picked for, otherwise it is a negative.
+
+        Mining (self._mining):
+        ALL - every valid (anchor, positive, negative) in the batch
+        BATCH_HARD - for each anchor, the positive with the smallest and
+                     the negative with the largest label similarity
+
+        Give: (ids, anchors, positives, negatives, margins)
+        ids: sample ids of distinct images in the batch
+        anchors, positives, negatives: positions in ids of each triplet
+        margins: similarity of positive pair - similarity of negative pair
+        """
+        if len(self._index) < self._p:
+            raise Exception("P x K sampling needs at least {} classes".format(
+                self._p))
+        classes = np.random.choice(self._index.keys(), self._p, replace=False)
+        slots = []
+        slot_classes = []
+        for class_ in classes:
+            members = self._index[class_]
+            slots.extend(np.random.choice(
+                members, self._k, replace=len(members) < self._k))
+            slot_classes.extend([class_] * self._k)
+        ids, inverse = np.unique(slots, return_inverse=True)
+        # multi-hot labels of distinct images, over labels in the batch
+        labels = [parse_label(self._labels[id]) for id in ids]
+        vocab = dict((label_, i) for i, label_ in
+                     enumerate(sorted(set(sum(labels, [])))))
+        multihot = np.zeros((len(ids), len(vocab)))
+        for i, labels_ in enumerate(labels):
+            multihot[i, [vocab[label_] for label_ in labels_]] = 1
+        # intersection / union of all pairs, same as intersect_sim
+        intersect = np.dot(multihot, multihot.T)
+        counts = multihot.sum(axis=1)
+        sim = intersect / (counts[:, np.newaxis] + counts - intersect)
+        # one anchor for each distinct (image, class) pair
+        anchor_pairs = sorted(set(
+            (inverse[i], vocab[slot_classes[i]]) for i in range(len(slots))))
+        anchor_ids = np.array([pair[0] for pair in anchor_pairs])
+        anchor_classes = np.array([pair[1] for pair in anchor_pairs])
+        has_class = multihot[:, anchor_classes].T > 0
+        pos_mask = has_class.copy()
+        pos_mask[np.arange(len(anchor_ids)), anchor_ids] = False
+        neg_mask = ~has_class
+        if self._mining == 'BATCH_HARD':
+            valid = pos_mask.any(axis=1) & neg_mask.any(axis=1)
+            # random tie breaking
+            noise = np.random.rand(*sim.shape) * 1e-6
+            anchor_sim = (sim + noise)[anchor_ids]
+            positives = np.where(pos_mask, anchor_sim, np.inf).argmin(axis=1)
+            negatives = np.where(neg_mask, anchor_sim, -np.inf).argmax(axis=1)
+            anchors = anchor_ids[valid]
+            positives = positives[valid]
+            negatives = negatives[valid]
+        else:
+            a, positives, negatives = np.nonzero(
+                pos_mask[:, :, np.newaxis] & neg_mask[:, np.newaxis, :])
+            anchors = anchor_ids[a]
+        # the same image picked for two classes gives duplicated triplets
+        triplets = np.unique(
+            np.vstack([anchors, positives, negatives]).T.copy().view(
+                [('', np.intp)] * 3)).view(np.intp).reshape(-1, 3)
+        anchors, positives, negatives = triplets.T
+        margins = sim[anchors, positives] - sim[anchors, negatives]
+        return (ids, anchors, positives, negatives, margins)
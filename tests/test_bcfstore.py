@@ -0,0 +1,145 @@
+"""Tests of bcf_store_http against local HTTP servers
+
+Run with: python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from utils.bcfstore import (bcf_writer, bcf_store_http)  # noqa: E402
+
+
+class PlainHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serve files of server.root, ignoring Range (always 200)"""
+    def translate_path(self, path):
+        return os.path.join(self.server.root, path.lstrip('/'))
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeHandler(PlainHandler):
+    """Serve byte ranges of files with 206, keep-alive"""
+    protocol_version = 'HTTP/1.1'
+    # one write per response, small writes stall on delayed ACKs
+    wbufsize = -1
+
+    def do_GET(self):
+        self.server.requests += 1
+        match = re.match(r'bytes=(\d+)-(\d+)',
+                         self.headers.get('Range', ''))
+        with open(self.translate_path(self.path), 'rb') as fp:
+            data = fp.read()
+        start, end = int(match.group(1)), int(match.group(2)) + 1
+        body = data[start:end]
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+            start, start + len(body) - 1, len(data)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_server(handler, root):
+    server = Server(('127.0.0.1', 0), handler)
+    server.root = root
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def write_bcf(filename, samples):
+    writer = bcf_writer(filename, len(samples))
+    for sample in samples:
+        writer.write(sample)
+    writer.close()
+
+
+class TestBCFStoreHTTP(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.root, 'cache')
+        self.samples = [os.urandom(i * 37 % 3000 + 1) for i in range(200)]
+        write_bcf(os.path.join(self.root, 'data.bcf'), self.samples)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.root)
+
+    def url(self, handler):
+        server = start_server(handler, self.root)
+        self.servers.append(server)
+        return 'http://127.0.0.1:{}/data.bcf'.format(
+            server.server_address[1])
+
+    def check_all(self, store, samples=None):
+        samples = samples or self.samples
+        self.assertEqual(store.size(), len(samples))
+        for i in range(len(samples)):
+            self.assertEqual(store.get(i), samples[i])
+
+    def test_range(self):
+        self.check_all(bcf_store_http(self.url(RangeHandler)))
+
+    def test_range_cached(self):
+        url = self.url(RangeHandler)
+        self.check_all(bcf_store_http(url, cache_dir=self.cache_dir,
+                                      chunk_size=4096))
+        # second time from the cache, only the header is requested
+        requests = self.servers[0].requests
+        self.check_all(bcf_store_http(url, cache_dir=self.cache_dir,
+                                      chunk_size=4096))
+        self.assertEqual(self.servers[0].requests, requests + 1)
+
+    def test_chunk_size_changed(self):
+        url = self.url(RangeHandler)
+        for chunk_size in [4096, 8192, 1000]:
+            self.check_all(bcf_store_http(url, cache_dir=self.cache_dir,
+                                          chunk_size=chunk_size))
+
+    def test_file_replaced(self):
+        url = self.url(RangeHandler)
+        self.check_all(bcf_store_http(url, cache_dir=self.cache_dir,
+                                      chunk_size=4096))
+        samples = [os.urandom(100) for i in range(50)]
+        write_bcf(os.path.join(self.root, 'data.bcf'), samples)
+        self.check_all(bcf_store_http(url, cache_dir=self.cache_dir,
+                                      chunk_size=4096), samples)
+
+    def test_truncated_chunk(self):
+        url = self.url(RangeHandler)
+        bcf_store_http(url, cache_dir=self.cache_dir, chunk_size=4096)
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for fn in filenames:
+                with open(os.path.join(dirpath, fn), 'r+b') as fp:
+                    fp.truncate(10)
+        self.check_all(bcf_store_http(url, cache_dir=self.cache_dir,
+                                      chunk_size=4096))
+
+    def test_range_ignored(self):
+        url = self.url(PlainHandler)
+        self.check_all(bcf_store_http(url))
+        self.check_all(bcf_store_http(url, cache_dir=self.cache_dir,
+                                      chunk_size=4096))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""Batch level data augmentation for python data layer
+
+Random crop, horizontal mirror and scale / aspect jitter are applied to a
+whole batch (n_samples * channels * height * width) at once,
+per-sample parameters are drawn in bulk and crops are taken by NumPy
+indexing, no python loop over samples.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+__authors__ = ['Xianming Liu (liuxianming@gmail.com)']
+
+
+class BatchAugmenter(object):
+    """BatchAugmenter
+
+    param in format of yaml object (param_str of the layer)
+
+    crop_size: int or [height, width] of output, default None (no crop)
+    crop_center: take center crops instead of random ones
+                 (e.g. for TEST net), default False
+    mirror: randomly flip half of the samples horizontally, default False
+    scale_jitter: [min, max] of crop window area relative to the image,
+                  the window is then resampled to crop_size, default None
+    aspect_jitter: [min, max] of crop window aspect ratio (width / height),
+                   default None
+    """
+    def __init__(self, param):
+        crop_size = param.get('crop_size', None)
+        if type(crop_size) in [tuple, list]:
+            self._crop_size = (int(crop_size[0]), int(crop_size[1]))
+        elif crop_size:
+            self._crop_size = (int(crop_size), int(crop_size))
+        else:
+            self._crop_size = None
+        self._crop_center = param.get('crop_center', False)
+        self._mirror = param.get('mirror', False)
+        self._scale_jitter = param.get('scale_jitter', None)
+        self._aspect_jitter = param.get('aspect_jitter', None)
+
+    def augment(self, batch):
+        """Augment batch of size (n_samples, channels, height, width)"""
+        n, channels, height, width = batch.shape
+        crop_h, crop_w = self._crop_size or (height, width)
+        if self._scale_jitter or self._aspect_jitter:
+            return self.jitter_crop(batch, crop_h, crop_w)
+        if (crop_h, crop_w) != (height, width):
+            if crop_h > height or crop_w > width:
+                raise Exception("crop_size larger than image")
+            if self._crop_center:
+                y = np.repeat((height - crop_h) // 2, n)
+                x = np.repeat((width - crop_w) // 2, n)
+            else:
+                y = np.random.randint(0, height - crop_h + 1, n)
+                x = np.random.randint(0, width - crop_w + 1, n)
+            # view of all crop windows, then pick one window per sample
+            strides = batch.strides
+            windows = as_strided(
+                batch,
+                shape=(n, channels, height - crop_h + 1, width - crop_w + 1,
+                       crop_h, crop_w),
+                strides=strides[:2] + strides[2:] + strides[2:])
+            batch = windows[np.arange(n), :, y, x]
+        if self._mirror and not self._crop_center:
+            flip = np.random.rand(n) < 0.5
+            batch[flip] = batch[flip, :, :, ::-1]
+        return batch
+
+    def jitter_crop(self, batch, crop_h, crop_w):
+        """Crop windows of random area and aspect ratio,
+        resampled to crop_h * crop_w by nearest neighbour indexing
+        """
+        n, channels, height, width = batch.shape
+        area = np.ones(n) * height * width
+        if self._scale_jitter:
+            area *= np.random.uniform(
+                self._scale_jitter[0], self._scale_jitter[1], n)
+        aspect = np.ones(n) * float(crop_w) / crop_h
+        if self._aspect_jitter:
+            aspect *= np.exp(np.random.uniform(
+                np.log(self._aspect_jitter[0]),
+                np.log(self._aspect_jitter[1]), n))
+        h = np.clip(np.sqrt(area / aspect), 1, height)
+        w = np.clip(np.sqrt(area * aspect), 1, width)
+        if self._crop_center:
+            y = (height - h) / 2
+            x = (width - w) / 2
+        else:
+            y = np.random.rand(n) * (height - h)
+            x = np.random.rand(n) * (width - w)
+        # source row / column of every output pixel: n * crop_h, n * crop_w
+        rows = (y[:, np.newaxis] + (np.arange(crop_h) + 0.5) *
+                (h / crop_h)[:, np.newaxis]).astype(np.intp)
+        cols = (x[:, np.newaxis] + (np.arange(crop_w) + 0.5) *
+                (w / crop_w)[:, np.newaxis]).astype(np.intp)
+        rows = np.minimum(rows, height - 1)
+        cols = np.minimum(cols, width - 1)
+        if self._mirror and not self._crop_center:
+            flip = np.random.rand(n) < 0.5
+            cols[flip] = cols[flip, ::-1]
+        return batch[np.arange(n)[:, None, None, None],
+                     np.arange(channels)[None, :, None, None],
+                     rows[:, None, :, None],
+                     cols[:, None, None, :]]
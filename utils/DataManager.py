@@ -15,7 +15,8 @@ self._labels is a list of string =
 labels are separated by :
 """
 
-from bcfstore import (bcf_store_file, bcf_store_memory)
+from bcfstore import (bcf_store_file, bcf_store_memory, bcf_store_http,
+                      bcf_read_scheduler)
 import sys
 import pandas as pd
 import numpy as np
@@ -38,15 +39,36 @@ class BCFDataManager():
     Data file: param['source']
     Label file: param['labels']
 
-    bcf_mode: param['bcf_mode'], (FILE or MEM) default = FILE
+    bcf_mode: param['bcf_mode'], (FILE, MEM or HTTP) default = FILE
+
+    In FILE and HTTP mode samples are read through bcf_read_scheduler:
+    bcf_read_threads: number of concurrent reads, default = 4
+    bcf_read_batch: number of samples per scheduled batch, default = 1024
+
+    HTTP mode: source is a http(s) url of the bcf file,
+    read with byte-range requests; label file stays local
+    bcf_http_connections: size of connection pool, default = 4
+    bcf_cache_dir: local on-disk chunk cache, default = None (no cache)
+    bcf_cache_chunk: chunk size of the cache in MB, default = 4
     """
     def __init__(self, param):
         self._source_fn = param.get('source')
         self._label_fn = param.get('labels')
         # bcf_mode: either FILE or MEM, default=FILE
         self._bcf_mode = param.get('bcf_mode', 'FILE')
-        if not os.path.isfile(self._source_fn) or \
-           not os.path.isfile(self._label_fn):
+        self._read_threads = int(param.get('bcf_read_threads', 4))
+        self._read_batch = int(param.get('bcf_read_batch', 1024))
+        if self._bcf_mode == 'HTTP':
+            if not os.path.isfile(self._label_fn):
+                raise Exception("Label file does not exist")
+            self._bcf = bcf_store_http(
+                self._source_fn,
+                num_connections=int(param.get('bcf_http_connections', 4)),
+                cache_dir=param.get('bcf_cache_dir', None),
+                chunk_size=int(
+                    float(param.get('bcf_cache_chunk', 4)) * 1024 * 1024))
+        elif not os.path.isfile(self._source_fn) or \
+                not os.path.isfile(self._label_fn):
             raise Exception("Either Source of Label file does not exist")
         else:
             if self._bcf_mode == 'MEM':
@@ -66,13 +88,15 @@ class BCFDataManager():
         """
         start = time.time()
         print("Start Loading Data from BCF {}".format(
-            'MEMORY' if self._bcf_mode == 'MEM' else 'FILE'))
+            'MEMORY' if self._bcf_mode == 'MEM' else self._bcf_mode))
 
         self._labels = np.loadtxt(self._label_fn).astype(str)
 
         if self._bcf.size() != self._labels.shape[0]:
             raise Exception("Number of samples in data"
                             "and labels are not equal")
+        elif self._bcf_mode in ['FILE', 'HTTP']:
+            self._data = self.fetch_all()
         else:
             for idx in range(self._bcf.size()):
                 datum_str = self._bcf.get(idx)
@@ -83,6 +107,26 @@ class BCFDataManager():
 
         return self._data, self._labels
 
+    def fetch_all(self):
+        """Read all samples batch by batch with coalesced reads,
+        the next batch is read while the current one is read and consumed
+        """
+        data = []
+        ids = range(self._bcf.size())
+        batches = [ids[i:i + self._read_batch]
+                   for i in range(0, len(ids), self._read_batch)]
+        scheduler = bcf_read_scheduler(self._bcf, self._read_threads)
+        try:
+            if batches:
+                scheduler.readahead(batches[0])
+            for b, batch in enumerate(batches):
+                if b + 1 < len(batches):
+                    scheduler.readahead(batches[b + 1])
+                data.extend(scheduler.fetch(batch))
+        finally:
+            scheduler.close()
+        return data
+
 
 class CSVDataManager():
     """CSVDataManager
@@ -159,14 +203,19 @@ class LMDBDataManager():
     Read and process images / labels from LMDB database
     param in format of yaml object
 
-    Data and Label file: param['source']
-    if there param['label'], then read labels from a separate lmdb
+    Data and Label file: param['source'] (LMDB environment directory)
+    if there param['label'], then read labels from a separate lmdb,
+    with samples in the same key order
     """
     def __init__(self, param):
         self._source_fn = param.get('source')
-        if not os.path.isfile(self._source_fn):
-            raise Exception("Source file does not exist")
+        if not os.path.isdir(self._source_fn):
+            raise Exception("Source LMDB {} does not exist".format(
+                self._source_fn))
         self._label_fn = param.get('labels', None)
+        if self._label_fn and not os.path.isdir(self._label_fn):
+            raise Exception("Label LMDB {} does not exist".format(
+                self._label_fn))
         self._data = []
         self._labels = []
 
@@ -179,37 +228,40 @@ class LMDBDataManager():
         labels: 0-based labels, in format of numpy array
         """
         start = time.time()
-        print("Start Loading Data from CSV File {}".format(
+        print("Start Loading Data from LMDB {}".format(
             self._source_fn))
         try:
-            db_ = lmdb.open(self._source_fn)
+            db_ = lmdb.open(self._source_fn, readonly=True, lock=False)
             data_cursor_ = db_.begin().cursor()
             if self._label_fn:
-                label_db_ = lmdb.open(self._label_fn)
-                label_cursor_ = label_db_.begin().cursor()
+                label_db_ = lmdb.open(self._label_fn, readonly=True,
+                                      lock=False)
+                label_cursor_ = label_db_.begin().cursor().iternext()
             # begin reading data
-            if self._label_fn:
-                label_cursor_.first()
-            while data_cursor_.next():
-                value_str = data_cursor_.value()
+            for key_, value_str in data_cursor_.iternext():
                 datum_ = caffe_pb2.Datum()
                 datum_.ParseFromString(value_str)
                 self._data.append(datum_.data)
                 if self._label_fn:
-                    label_cursor_.next()
+                    label_key_, label_str = next(label_cursor_)
                     label_datum_ = caffe_pb2.Datum()
-                    label_datum_.ParseFromString(label_cursor_.value())
+                    label_datum_.ParseFromString(label_str)
                     label_ = caffe.io.datum_to_array(label_datum_)
-                    label_ = ":".join([str(x) for x in label_.astype(int)])
+                    label_ = ":".join(
+                        [str(x) for x in label_.flatten().astype(int)])
                 else:
                     label_ = str(datum_.label)
-                self._labels.appen(label_)
+                self._labels.append(label_)
             # close all db
             db_.close()
             if self._label_fn:
                 label_db_.close()
-        except:
-            raise Exception("Error in Parsing input file")
+        except StopIteration:
+            raise Exception("Label LMDB {} has fewer entries than {}".format(
+                self._label_fn, self._source_fn))
+        except Exception:
+            raise Exception("Error in Parsing input file {}: {}".format(
+                self._source_fn, sys.exc_info()[1]))
         end = time.time()
         self._labels = np.array(self._labels)
         print("Loading {} samples Done: Time cost {} seconds".format(
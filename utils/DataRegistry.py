@@ -0,0 +1,72 @@
+"""Process-wide registry of datasets shared by python data layers
+
+Layers built on the same source (TRAIN and TEST nets, several branches)
+load data, labels and derived products (sampler index, decompressed
+images) once. Entries are reference counted, and removed when the last
+layer releases them.
+
+Shared data are read only: layers keep their own cursor and shuffle
+order, and never modify the shared lists in place.
+"""
+
+import threading
+
+__authors__ = ['Xianming Liu (liuxianming@gmail.com)']
+
+# parameters of DataManager that change what is loaded
+DATA_MANAGER_KEYS = ['source', 'labels', 'root', 'header', 'bcf_mode']
+
+_datasets = dict()
+_lock = threading.RLock()
+
+
+class SharedDataset(object):
+    """Data and labels of one source, plus cached derived products"""
+    def __init__(self, key, data, labels):
+        self.key = key
+        # tuple, so that no layer can modify it in place
+        self.data = tuple(data)
+        self.labels = labels
+        if hasattr(labels, 'flags'):
+            labels.flags.writeable = False
+        self._refs = 0
+        self._products = dict()
+
+    def product(self, key, build):
+        """Give product stored under key, calling build() the first time,
+        e.g. sampler index or decompressed data
+        """
+        with _lock:
+            if key not in self._products:
+                self._products[key] = build()
+            return self._products[key]
+
+
+def dataset_key(source_type, param):
+    return (source_type,) + tuple(
+        (key, repr(param.get(key, None))) for key in DATA_MANAGER_KEYS)
+
+
+def acquire(key, load):
+    """Give SharedDataset of key, calling load() -> (data, labels)
+    if it is not loaded yet. Call release(key) when done with it
+    """
+    with _lock:
+        if key not in _datasets:
+            data, labels = load()
+            _datasets[key] = SharedDataset(key, data, labels)
+        else:
+            print("Using shared data of {}".format(key[0:2]))
+        dataset = _datasets[key]
+        dataset._refs += 1
+        return dataset
+
+
+def release(key):
+    with _lock:
+        dataset = _datasets.get(key, None)
+        if dataset is None:
+            return
+        dataset._refs -= 1
+        if dataset._refs <= 0:
+            del _datasets[key]
@@ -0,0 +1,111 @@
+"""Adaptive tuning of prefetch workers and queue depth
+
+The data layer reports for every consumed batch how long it waited for it
+and how long the worker spent producing it. Every `interval` batches the
+tuner compares the production cost with the time the consumer (the solver)
+spends per batch, and grows or shrinks the number of prefetch workers and
+the queue depth within CPU and memory bounds.
+"""
+
+import math
+import time
+from multiprocessing import cpu_count
+
+__authors__ = ['Xianming Liu (liuxianming@gmail.com)']
+
+
+class PrefetchTuner(object):
+    """PrefetchTuner
+
+    workers: number of prefetch processes
+    depth: number of finished batches allowed to wait in the queue
+
+    Bounds:
+    min_workers / max_workers: max_workers defaults to #cpu - 1,
+        leaving one core to the solver
+    max_depth: maximum queue depth
+    max_memory: bytes allowed for batches in flight,
+        (workers + depth) * batch size
+    stall: fraction of consumer time spent waiting that triggers growing
+    """
+    def __init__(self, workers, depth,
+                 min_workers=1, max_workers=None,
+                 min_depth=1, max_depth=8,
+                 max_memory=2 * 1024 ** 3,
+                 interval=20, stall=0.05):
+        self.workers = workers
+        self.depth = depth
+        self._min_workers = min_workers
+        self._max_workers = max_workers or max(1, cpu_count() - 1)
+        self._min_depth = min_depth
+        self._max_depth = max_depth
+        self._max_memory = max_memory
+        self._interval = interval
+        self._stall = stall
+        self._last = None
+        self._waits = []
+        self._costs = []
+        self._consume = []
+        self._batch_bytes = 0
+
+    def update(self, wait, cost, batch_bytes):
+        """Record one consumed batch
+
+        wait: seconds the consumer blocked on the queue
+        cost: seconds the worker spent producing the batch
+        batch_bytes: size of the batch
+
+        Give: (workers, depth, reason) if the tuner decides on a change,
+              otherwise None
+        """
+        now = time.time()
+        if self._last is not None:
+            # time the consumer spent on its own since the last batch
+            self._consume.append(max(now - self._last - wait, 0.))
+        self._last = now
+        self._waits.append(wait)
+        self._costs.append(cost)
+        self._batch_bytes = batch_bytes
+        if len(self._waits) < self._interval or not self._consume:
+            return None
+        decision = self.decide(
+            sum(self._waits) / len(self._waits),
+            sum(self._costs) / len(self._costs),
+            sum(self._consume) / len(self._consume))
+        self._waits, self._costs, self._consume = [], [], []
+        return decision
+
+    def decide(self, wait, cost, consume):
+        workers, depth = self.workers, self.depth
+        # workers needed to keep up, with 25% headroom
+        needed = int(math.ceil(1.25 * cost / max(consume, 1e-6)))
+        stats = "wait {:.4f}s, cost {:.4f}s, consume {:.4f}s".format(
+            wait, cost, consume)
+        if wait > self._stall * (wait + consume):
+            if workers < min(needed, self._max_workers):
+                workers = min(needed, self._max_workers)
+                reason = "consumer stalls, too few workers"
+            else:
+                depth = min(depth + 1, self._max_depth)
+                reason = "consumer stalls, bursty production"
+        elif workers > max(needed, self._min_workers):
+            workers -= 1
+            reason = "workers idle"
+        else:
+            reason = "steady"
+        # memory bound, shrink queue first, then workers
+        if self._batch_bytes:
+            max_batches = max(
+                self._max_memory // self._batch_bytes,
+                self._min_workers + self._min_depth)
+            if workers + depth > max_batches:
+                reason += ", memory bound"
+            while workers + depth > max_batches:
+                if depth > self._min_depth:
+                    depth -= 1
+                else:
+                    workers -= 1
+        if (workers, depth) == (self.workers, self.depth):
+            return None
+        self.workers, self.depth = workers, depth
+        return workers, depth, "{} ({})".format(reason, stats)
@@ -6,9 +6,13 @@ import os.path
 import numpy as np
 import scipy.misc
 from cStringIO import StringIO
+from PIL import Image
+from multiprocessing.pool import ThreadPool
 
 __author__ = ['Xianming Liu(liuxianming@gmail.com']
 
+NPY_MAGIC = '\x93NUMPY'
+
 
 def extract_sample(img, image_mean=None, resize=-1):
     """Extract image content from image string or from file
@@ -18,20 +22,8 @@ def extract_sample(img, image_mean=None, resize=-1):
     resize - to resize image, set resize > 0; otherwise, don't resize
     """
     try:
-        # if input is a file name, then read image; otherwise decode_imgstr
-        if type(img) is np.ndarray:
-            img_data = img
-        else:
-            img_data = decode_imgstr(img)
-        if type(resize) in [tuple, list]:
-            # resize in two dimensions
-            img_data = scipy.misc.imresize(img_data, (resize[0], resize[1]))
-        elif resize > 0:
-            img_data = scipy.misc.imresize(img_data, (resize, resize))
+        img_data = decode_sample(img, resize)
         img_data = img_data.astype(np.float32, copy=False)
-        img_data = img_data[:, :, ::-1]
-        # change channel for caffe:
-        img_data = img_data.transpose(2, 0, 1)  # to CxHxW
         # substract_mean
         if image_mean is not None:
             img_data = substract_mean(img_data, image_mean)
@@ -41,11 +33,51 @@ def extract_sample(img, image_mean=None, resize=-1):
         return
 
 
+def decode_sample(img, resize=-1):
+    """Decode and resize image, without mean substraction
+
+    Give uint8 numpy array in caffe layout: BGR, CxHxW
+    """
+    # if input is a file name, then read image; otherwise decode_imgstr
+    if type(img) is np.ndarray:
+        img_data = img
+    else:
+        img_data = decode_imgstr(img)
+    if type(resize) in [tuple, list]:
+        size = (resize[0], resize[1])
+    elif resize > 0:
+        size = (resize, resize)
+    else:
+        size = img_data.shape[:2]
+    # images re-encoded at training resolution skip resizing
+    if img_data.shape[:2] != tuple(size):
+        img_data = scipy.misc.imresize(img_data, size)
+    img_data = img_data[:, :, ::-1]
+    # change channel for caffe:
+    img_data = img_data.transpose(2, 0, 1)  # to CxHxW
+    return img_data
+
+
 def decode_imgstr(imgstr):
+    if imgstr.startswith(NPY_MAGIC):
+        # raw uint8 pixels stored in numpy format
+        return np.load(StringIO(imgstr))
     img_data = scipy.misc.imread(StringIO(imgstr))
     return img_data
 
 
+def encode_img(img_data, quality=95, raw=False):
+    """Encode HxWxC uint8 image as JPEG string,
+    or in numpy format if raw, which decode_imgstr reads without decoding
+    """
+    buf = StringIO()
+    if raw:
+        np.save(buf, np.ascontiguousarray(img_data, dtype=np.uint8))
+    else:
+        Image.fromarray(img_data).save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
 def substract_mean(img, image_mean):
     """Substract image mean from data sample
 
@@ -56,3 +88,119 @@ def substract_mean(img, image_mean):
         image_mean = image_mean[:, np.newaxis, np.newaxis]
     img -= image_mean
     return img
+
+
+class BatchDecoder(object):
+    """Decode a whole batch, optionally with a pool of threads
+
+    PIL releases the GIL while decoding and resizing,
+    so threads give most of the multi-core speed up in the same process.
+    Samples are written into one array allocated for the batch,
+    all samples must have the same shape after decoding.
+
+    With an augmenter (BatchAugmenter), samples are decoded as uint8,
+    augmented as a batch, then converted to float and mean substracted;
+    a full image mean is reduced to channel mean, since crops change size.
+
+    compressed: False if samples are already decoded numpy arrays
+    num_threads: 0 to decode in the calling thread
+    transport: dtype of the batches given by decode()
+        float32 - mean substracted
+        float16 - mean substracted, half of the bytes
+        uint8 - raw pixels, a quarter of the bytes, the consumer converts
+                to float and calls substract_mean()
+
+    Samples that can not be decoded are left as zeros,
+    their positions in the last batch are kept in self.failed;
+    if none of them can be decoded, decode() gives None.
+    Samples of different sizes raise an exception, set resize
+
+    Create it in the process that uses it, threads do not survive fork
+    """
+    def __init__(self, num_threads=0, image_mean=None, resize=-1,
+                 augmenter=None, compressed=True, transport='float32'):
+        self._pool = None
+        if num_threads > 0:
+            self._pool = ThreadPool(num_threads)
+        self._mean = image_mean
+        self._resize = resize
+        self._augmenter = augmenter
+        self._compressed = compressed
+        self._transport = transport
+        self.failed = []
+        if augmenter is not None and image_mean is not None and \
+           image_mean.ndim == 3:
+            self._mean = image_mean.mean(axis=(1, 2))
+
+    def decode(self, samples):
+        """Give numpy array of size (n_samples, channels, height, width)"""
+        self.failed = []
+        if not self._compressed:
+            # samples that failed to decompress are None
+            batch = self.decode_all(samples, lambda x: x)
+        else:
+            # mean is substracted from the whole batch, so that only
+            # failures of decoding land in self.failed
+            batch = self.decode_all(
+                samples, lambda x: decode_sample(x, self._resize))
+        if batch is None:
+            return
+        if self._augmenter is not None:
+            batch = self._augmenter.augment(batch)
+        if batch.dtype == np.uint8 and self._transport != 'uint8':
+            batch = self.substract_mean(batch.astype(np.float32))
+        if self._transport == 'float16':
+            batch = batch.astype(np.float16)
+        return batch
+
+    def substract_mean(self, batch):
+        """Substract mean from float batch, in place"""
+        if self._mean is not None:
+            batch = substract_mean(batch, self._mean)
+        return batch
+
+    def decode_all(self, samples, decode_one):
+        def try_decode(i):
+            try:
+                return decode_one(samples[i])
+            except:
+                print sys.exc_info()[0], sys.exc_info()[1]
+                return
+
+        # the first decodable sample gives the shape of the batch
+        first = None
+        for start in range(len(samples)):
+            first = try_decode(start)
+            if first is not None:
+                break
+            self.failed.append(start)
+        if first is None:
+            # all in self.failed, the caller samples again
+            return
+        batch = np.zeros((len(samples),) + first.shape, dtype=first.dtype)
+        batch[start] = first
+
+        def decode_into(i):
+            datum = try_decode(i)
+            if datum is None:
+                self.failed.append(i)
+            elif datum.shape != first.shape:
+                # not corrupt, the configuration is wrong
+                raise Exception(
+                    "Sample of size {} differs from size {} of the batch, "
+                    "set resize to decode samples of different sizes".format(
+                        datum.shape, first.shape))
+            else:
+                batch[i] = datum
+        if self._pool is not None:
+            self._pool.map(decode_into, range(start + 1, len(samples)))
+        else:
+            for i in range(start + 1, len(samples)):
+                decode_into(i)
+        self.failed.sort()
+        return batch
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
@@ -0,0 +1,194 @@
+"""CPU placement of data layer processes
+
+Pin prefetch processes to sets of cores, NUMA aware, keeping some cores
+for the main (solver) process, and cap the threads that numpy / BLAS
+and image libraries spawn inside each process.
+"""
+
+import os
+import sys
+import glob
+import ctypes
+from multiprocessing import cpu_count
+
+__authors__ = ['Xianming Liu (liuxianming@gmail.com)']
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS']
+
+# runtime thread setters of BLAS / OpenMP libraries, all take one int
+THREAD_SETTERS = ['openblas_set_num_threads', 'mkl_set_num_threads',
+                  'bli_thread_set_num_threads', 'omp_set_num_threads']
+THREAD_LIBRARIES = ['blas', 'mkl', 'omp', 'blis']
+
+# cores of the process before pin_main_process(), workers are planned
+# over them
+_process_cpus = None
+
+
+def parse_cpulist(cpulist):
+    """Parse cpu list in format of "0-3,8,10-11" into list of int"""
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def get_affinity(pid=0):
+    """Cores the process is allowed to run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(pid))
+    try:
+        import psutil
+        return sorted(psutil.Process(pid or os.getpid()).cpu_affinity())
+    except (ImportError, AttributeError):
+        return range(cpu_count())
+
+
+def set_affinity(cpus, pid=0):
+    """Pin process to cpus, give False if not supported"""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(pid, cpus)
+        return True
+    try:
+        import psutil
+        psutil.Process(pid or os.getpid()).cpu_affinity(list(cpus))
+        return True
+    except (ImportError, AttributeError):
+        print("Setting CPU affinity is not supported, install psutil")
+        return False
+
+
+def numa_nodes():
+    """List of cores of each NUMA node, a single node if unknown"""
+    available = set(_process_cpus or get_affinity())
+    nodes = []
+    for fn in sorted(glob.glob('/sys/devices/system/node/node*/cpulist')):
+        with open(fn) as fp:
+            cpus = [c for c in parse_cpulist(fp.read()) if c in available]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(available)]
+
+
+def reserved_cpus(reserved=1, nodes=None):
+    """Cores kept for the main process, reserved is either a list of
+    cores or a number of cores taken from the first NUMA node
+    """
+    if type(reserved) is int:
+        if nodes is None:
+            nodes = numa_nodes()
+        return nodes[0][:reserved]
+    return list(reserved)
+
+
+def pin_main_process(reserved=1):
+    """Pin the calling (solver) process to the reserved cores
+
+    Workers pinned to their own cores are not affected, workers without
+    affinity inherit the reserved cores if started later.
+    Give the cores, or None if not supported
+    """
+    global _process_cpus
+    cpus = reserved_cpus(reserved)
+    if _process_cpus is None:
+        _process_cpus = get_affinity()
+    if not set_affinity(cpus):
+        return None
+    return cpus
+
+
+def plan_worker_cpus(n_workers, cores_per_worker=1, reserved=1, cpus=None):
+    """Assign core sets to workers
+
+    reserved: cores kept for the main process, either a list of cores
+              or a number of cores taken from the first NUMA node
+    cpus: cores usable by workers, default all available ones
+
+    Cores of a worker come from one NUMA node, workers are spread over
+    nodes in turn. If there are not enough cores, workers share sets.
+
+    Give: list of n_workers core lists
+    """
+    nodes = numa_nodes()
+    reserved = set(reserved_cpus(reserved, nodes))
+    if cpus is not None:
+        cpus = set(cpus)
+        nodes = [[c for c in node if c in cpus] for node in nodes]
+    if all(set(node) <= reserved for node in nodes):
+        print("No cores left besides reserved ones, sharing them")
+        reserved = set()
+    nodes = [[c for c in node if c not in reserved] for node in nodes]
+    # split every node into core sets, then interleave the nodes
+    node_sets = [[node[i:i + cores_per_worker]
+                  for i in range(0, len(node), cores_per_worker)]
+                 for node in nodes if node]
+    core_sets = []
+    for i in range(max([len(sets) for sets in node_sets] or [0])):
+        core_sets.extend(sets[i] for sets in node_sets if i < len(sets))
+    if not core_sets:
+        raise Exception("No cores available for prefetch workers")
+    return [core_sets[i % len(core_sets)] for i in range(n_workers)]
+
+
+def loaded_libraries():
+    """Paths of shared libraries loaded in this process (Linux only)"""
+    libs = set()
+    try:
+        with open('/proc/self/maps') as fp:
+            for line in fp:
+                path = line.split()[-1]
+                if '.so' in os.path.basename(path):
+                    libs.add(path)
+    except IOError:
+        pass
+    return sorted(libs)
+
+
+def set_lib_threads(n_threads):
+    """Call the thread setters of BLAS / OpenMP libraries
+    already loaded in this process
+
+    Give: list of setters called, each once
+    """
+    called = []
+    for path in loaded_libraries():
+        if not any(name in os.path.basename(path).lower()
+                   for name in THREAD_LIBRARIES):
+            continue
+        try:
+            # already loaded, only gives a handle
+            lib = ctypes.CDLL(path)
+        except OSError:
+            continue
+        for setter in THREAD_SETTERS:
+            try:
+                getattr(lib, setter)(ctypes.c_int(n_threads))
+                if setter not in called:
+                    called.append(setter)
+            except AttributeError:
+                pass
+    return called
+
+
+def limit_threads(n_threads):
+    """Cap threads of numpy / BLAS, OpenMP and OpenCV in this process
+
+    Environment variables only cover libraries loaded later,
+    libraries already loaded (e.g. BLAS of numpy, loaded before
+    prefetch processes are forked) are capped by their own setters
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    called = set_lib_threads(n_threads)
+    if 'cv2' in sys.modules:
+        sys.modules['cv2'].setNumThreads(n_threads)
+        called.append('cv2.setNumThreads')
+    return called
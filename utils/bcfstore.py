@@ -1,4 +1,12 @@
 import numpy
+import os
+import hashlib
+import httplib
+import socket
+import threading
+import Queue
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
 
 
 class bcf_store_memory():
@@ -19,10 +27,44 @@ class bcf_store_memory():
     def get(self, i):
         return self._memory[self._offsets[i]:self._offsets[i+1]]
 
+    def range(self, i):
+        return int(self._offsets[i]), int(self._offsets[i+1])
+
+    def read_range(self, start, end):
+        return self._memory[start:end]
+
     def size(self):
         return len(self._offsets)-1
 
 
+class bcf_writer():
+    """Write a BCF file of size samples, one sample at a time
+
+    Space for the header is reserved first,
+    sizes are written into it by close()
+    """
+    def __init__(self, filename, size):
+        self._filename = filename
+        self._size = size
+        self._file_sizes = []
+        self._file = open(filename, 'wb')
+        self._file.write(numpy.array([size], dtype=numpy.uint64).tostring())
+        self._file.write('\0' * (8*size))
+
+    def write(self, datum):
+        self._file.write(datum)
+        self._file_sizes.append(len(datum))
+
+    def close(self):
+        if len(self._file_sizes) != self._size:
+            raise Exception("{} samples written to {}, expected {}".format(
+                len(self._file_sizes), self._filename, self._size))
+        self._file.seek(8)
+        self._file.write(
+            numpy.array(self._file_sizes, dtype=numpy.uint64).tostring())
+        self._file.close()
+
+
 class bcf_store_file():
     def __init__(self, filename):
         self._filename = filename
@@ -33,13 +75,285 @@ class bcf_store_file():
                                       dtype=numpy.uint64)
         self._offsets = numpy.append(numpy.uint64(0),
                                      numpy.add.accumulate(file_sizes))
+        # header: sample count + one size per sample
+        self._data_start = len(self._offsets)*8
+        # every reading thread gets its own file handle
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
 
     def __del__(self):
         self._file.close()
+        for handle in self._handles:
+            handle.close()
 
     def get(self, i):
         self._file.seek(len(self._offsets)*8+int(self._offsets[i]))
         return self._file.read(self._offsets[i+1]-self._offsets[i])
 
+    def range(self, i):
+        return int(self._offsets[i]), int(self._offsets[i+1])
+
+    def read_range(self, start, end):
+        """Read bytes [start, end) of the data section, thread safe"""
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            handle = open(self._filename, 'rb')
+            self._local.handle = handle
+            with self._lock:
+                self._handles.append(handle)
+        handle.seek(self._data_start + start)
+        return handle.read(end - start)
+
+    def size(self):
+        return len(self._offsets)-1
+
+
+class bcf_store_http():
+    """BCF file served over HTTP, read by byte-range requests
+
+    Header and offsets table are fetched once at construction,
+    samples are read with Range requests over a pool of keep-alive
+    connections (at most num_connections).
+
+    If cache_dir is given, the file is cached on local disk in chunks of
+    chunk_size bytes, and only missing chunks are requested
+    (contiguous missing chunks in one request).
+    The cache is kept per url, chunk size and version of the remote file
+    (size, ETag and Last-Modified), cached chunks of the wrong length
+    are requested again.
+    """
+    def __init__(self, url, num_connections=4, cache_dir=None,
+                 chunk_size=4 * 1024 * 1024, timeout=60):
+        self._filename = url
+        print 'Opening remote BCF file ... '+url
+        parsed = urlparse(url)
+        if parsed.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        else:
+            self._connection_class = httplib.HTTPConnection
+        self._netloc = parsed.netloc
+        self._path = parsed.path + ('?' + parsed.query if parsed.query else '')
+        self._timeout = timeout
+        self._connections = Queue.Queue()
+        # idle connections are kept in the queue, at most num_connections
+        self._slots = threading.Semaphore(num_connections)
+        self._chunk_size = chunk_size
+        self._cache_dir = None
+        # (size, ETag, Last-Modified) of the remote file
+        self._version = None
+        # not cached, gives the version of the file first
+        size = numpy.fromstring(self._request(0, 8), dtype=numpy.uint64)
+        if cache_dir:
+            key = repr((url, chunk_size) + self._version)
+            self._cache_dir = os.path.join(
+                cache_dir, hashlib.sha1(key).hexdigest())
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir)
+        file_sizes = numpy.fromstring(self._read(8, 8 + 8*int(size)),
+                                      dtype=numpy.uint64)
+        self._offsets = numpy.append(numpy.uint64(0),
+                                     numpy.add.accumulate(file_sizes))
+        self._data_start = len(self._offsets)*8
+
+    def __del__(self):
+        while not self._connections.empty():
+            self._connections.get().close()
+
+    def _request(self, start, end):
+        """GET bytes [start, end) of the remote file, retry once
+        on a fresh connection if a kept-alive one went stale"""
+        self._slots.acquire()
+        try:
+            for attempt in range(2):
+                try:
+                    conn = self._connections.get_nowait()
+                except Queue.Empty:
+                    conn = self._connection_class(
+                        self._netloc, timeout=self._timeout)
+                try:
+                    conn.request('GET', self._path, headers={
+                        'Range': 'bytes={}-{}'.format(start, end - 1)})
+                    response = conn.getresponse()
+                    body = response.read()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    if attempt:
+                        raise
+                    continue
+                self._connections.put(conn)
+                if response.status not in [200, 206]:
+                    raise Exception("HTTP {} when reading {}".format(
+                        response.status, self._filename))
+                if self._version is None:
+                    self._version = self._response_version(response, body)
+                if response.status == 206:
+                    return body
+                else:
+                    # server ignored the range
+                    return body[start:end]
+        finally:
+            self._slots.release()
+
+    def _response_version(self, response, body):
+        """Size, ETag and Last-Modified of the remote file"""
+        if response.status == 206:
+            # Content-Range: bytes start-end/size
+            size = response.getheader('content-range', '').split('/')[-1]
+            size = int(size) if size.isdigit() else None
+        else:
+            size = len(body)
+        return (size, response.getheader('etag'),
+                response.getheader('last-modified'))
+
+    def _chunk_length(self, chunk):
+        """Expected length of a chunk, None if the size is unknown"""
+        size = self._version[0]
+        if size is None:
+            return None
+        return max(min(self._chunk_size, size - chunk * self._chunk_size), 0)
+
+    def _chunk_fn(self, chunk):
+        return os.path.join(self._cache_dir, str(chunk))
+
+    def _read(self, start, end):
+        """Read bytes [start, end) of the file, through the chunk cache"""
+        if end <= start:
+            return ''
+        if self._cache_dir is None:
+            return self._request(start, end)
+        first = start // self._chunk_size
+        last = (end - 1) // self._chunk_size
+        chunks = dict()
+        missing = []
+        for chunk in range(first, last + 1):
+            try:
+                with open(self._chunk_fn(chunk), 'rb') as fp:
+                    content = fp.read()
+            except IOError:
+                missing.append(chunk)
+                continue
+            length = self._chunk_length(chunk)
+            if length is not None and len(content) != length:
+                missing.append(chunk)
+            else:
+                chunks[chunk] = content
+        # one request for each run of contiguous missing chunks
+        runs = []
+        for chunk in missing:
+            if runs and runs[-1][-1] == chunk - 1:
+                runs[-1].append(chunk)
+            else:
+                runs.append([chunk])
+        for run in runs:
+            body = self._request(run[0] * self._chunk_size,
+                                 (run[-1] + 1) * self._chunk_size)
+            for k, chunk in enumerate(run):
+                content = body[k * self._chunk_size:
+                               (k + 1) * self._chunk_size]
+                chunks[chunk] = content
+                # write then rename, other readers never see partial chunks
+                tmp_fn = '{}.{}.{}'.format(
+                    self._chunk_fn(chunk), os.getpid(),
+                    threading.current_thread().ident)
+                with open(tmp_fn, 'wb') as fp:
+                    fp.write(content)
+                os.rename(tmp_fn, self._chunk_fn(chunk))
+        buf = ''.join(chunks[chunk] for chunk in range(first, last + 1))
+        offset = start - first * self._chunk_size
+        return buf[offset:offset + end - start]
+
+    def get(self, i):
+        return self.read_range(*self.range(i))
+
+    def range(self, i):
+        return int(self._offsets[i]), int(self._offsets[i+1])
+
+    def read_range(self, start, end):
+        return self._read(self._data_start + start, self._data_start + end)
+
     def size(self):
         return len(self._offsets)-1
+
+
+class bcf_read_scheduler():
+    """Batch-aware reader on top of a bcf store
+
+    All sample ids of a batch are sorted by offset, adjacent or nearby
+    ranges (closer than max_gap bytes) are merged into reads of at most
+    max_read bytes, the reads are issued concurrently and each id gets
+    its own slice back, in the order it was requested.
+
+    readahead(ids) starts fetching a batch in background, up to depth
+    batches are read at the same time, a following fetch(ids) with the
+    same ids picks up the result. Call readahead for batch b + 1 before
+    fetch of batch b, so that batch b + 1 is read while batch b is
+    finished and consumed.
+
+    The store needs to provide range(i) and read_range(start, end)
+    """
+    def __init__(self, store, num_threads=4,
+                 max_gap=64 * 1024, max_read=16 * 1024 * 1024, depth=2):
+        self._store = store
+        self._max_gap = max_gap
+        self._max_read = max_read
+        self._depth = depth
+        self._pool = ThreadPool(num_threads)
+        # separate pool, readahead itself waits on self._pool
+        self._readahead_pool = ThreadPool(depth)
+        # [(ids, result)], oldest first
+        self._pending = []
+
+    def plan(self, ids):
+        """Group ids into coalesced reads
+
+        Give: list of (start, end, [(id, start, end), ...])
+        """
+        ranges = sorted((self._store.range(i) + (i,)) for i in set(ids))
+        chunks = []
+        for start, end, i in ranges:
+            if chunks and start - chunks[-1][1] <= self._max_gap and \
+               end - chunks[-1][0] <= self._max_read:
+                chunks[-1][1] = max(chunks[-1][1], end)
+                chunks[-1][2].append((i, start, end))
+            else:
+                chunks.append([start, end, [(i, start, end)]])
+        return chunks
+
+    def _read_chunk(self, chunk):
+        chunk_start, chunk_end, members = chunk
+        buf = self._store.read_range(chunk_start, chunk_end)
+        return [(i, buf[start - chunk_start:end - chunk_start])
+                for i, start, end in members]
+
+    def _fetch(self, ids):
+        samples = dict()
+        for part in self._pool.map(self._read_chunk, self.plan(ids)):
+            samples.update(part)
+        return [samples[i] for i in ids]
+
+    def fetch(self, ids):
+        """Read all samples of ids, in the given order"""
+        ids = list(ids)
+        for n, (pending_ids, result) in enumerate(self._pending):
+            if pending_ids == ids:
+                # older readaheads were skipped, drop them
+                for _, skipped in self._pending[:n]:
+                    skipped.wait()
+                self._pending = self._pending[n + 1:]
+                return result.get()
+        return self._fetch(ids)
+
+    def readahead(self, ids):
+        """Start reading ids in background"""
+        ids = list(ids)
+        if len(self._pending) >= self._depth:
+            # drop the oldest one, never fetched
+            self._pending.pop(0)[1].wait()
+        self._pending.append((ids, self._readahead_pool.apply_async(
+            self._fetch, (ids,))))
+
+    def close(self):
+        for pool in [self._pool, self._readahead_pool]:
+            pool.close()
+            pool.join()
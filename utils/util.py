@@ -14,6 +14,23 @@ def parse_label(labels):
     return [int(x) for x in str(labels).split(':')]
 
 
+def build_index(labels):
+    """Build index of samples by label
+
+    The index is in the format of python dict
+    {label: [list of sample id]}
+    """
+    index = dict()
+    for id in range(len(labels)):
+        # parse label and insert into index
+        for label_ in parse_label(labels[id]):
+            if label_ in index:
+                index[label_].append(id)
+            else:
+                index[label_] = [id]
+    return index
+
+
 def intersect_sim(array_1, array_2):
     """Calculate the simiarity of two arrays
     by using intersection / union